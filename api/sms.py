@@ -1,59 +1,439 @@
 # api/sms.py
 import os
 import logging
-import re
+import base64
+import hashlib
+import hmac
 import html
-from typing import List, Optional, Tuple
+import json
+import queue
+import random
+import re
+import signal
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Tuple
 from flask import Flask, request
 import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+
+try:
+    import orjson
+except ImportError:  # optional speedup; stdlib json is used when it isn't installed
+    orjson = None
+
+try:
+    import ijson
+except ImportError:  # optional; the legacy board scan parses the full response without it
+    ijson = None
 
 app = Flask(__name__)
-logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
 
 MONDAY_API_URL = "https://api.monday.com/v2"
 MONDAY_ITEMS_PAGE_LIMIT = 500  # adjust if board has more than 500 rows
+MAX_WEBHOOK_BYTES = 32 * 1024  # Twilio SMS payloads are well under this, even for 1600-char emoji bodies
+# Each Monday call, retries included, finishes within MONDAY_CALL_BUDGET seconds --
+# the same worst case as a single timed-out request. Inline, an SMS makes up to
+# three sequential calls (five with MONDAY_LEGACY_SCAN), which can still exceed
+# Twilio's ~15s webhook window when Monday is slow; set BACKGROUND_WORKER=1 where
+# that matters.
+MONDAY_REQUEST_TIMEOUT = 10.0
+MONDAY_CALL_BUDGET = 10.0
+DEFAULT_CONTACT_CACHE_TTL = 300.0  # seconds; override with MONDAY_CONTACT_CACHE_TTL
+
+# Process-local index of normalized phone -> (contact name, item id). Entries come
+# from server-side phone lookups and, with MONDAY_LEGACY_SCAN=1, from full board
+# scans ("scanned" marks that by_phone holds the whole board). Cleared on expiry;
+# the last full scan, its newest item updated_at and the board's items_count
+# survive expiry so an unchanged board can be revalidated with a one-row query
+# instead of a rescan.
+_contact_cache = {
+    "expires": 0.0,
+    "by_phone": {},
+    "scanned": False,
+    "board_index": None,
+    "board_updated_at": None,
+    "board_items_count": None,
+}
+_contact_cache_lock = threading.Lock()
+# Serializes legacy board scans; held across network I/O so the cache lock never is.
+_contact_refresh_lock = threading.Lock()
+
+# Precompiled so per-call normalization skips the re module's pattern cache lookup.
+_NON_DIGITS = re.compile(r"\D+")
+
+# Process-wide resources (HTTP session, thread pool, background worker), created
+# on first use by _get_state() instead of at import to keep cold starts light.
+_state: Dict[str, Any] = {}
+_state_lock = threading.Lock()
+_logging_configured = False
+
+_Q_NOTIFY = """
+mutation ($user_id: ID!, $target_id: ID!, $target_type: NotificationTargetType!, $text: String!) {
+  create_notification(user_id: $user_id, target_id: $target_id, target_type: $target_type, text: $text) {
+    id
+  }
+}
+"""
 
+_Q_LOOKUP = """
+query ($board_id: [ID!], $limit: Int!, $column_ids: [String!]) {
+  boards(ids: $board_id) {
+    items_count
+    items_page(limit: $limit) {
+      items {
+        id
+        name
+        updated_at
+        column_values(ids: $column_ids) {
+          id
+          text
+        }
+      }
+    }
+  }
+}
+"""
+
+_Q_LOOKUP_BY_PHONE = """
+query ($board_id: ID!, $column_id: String!, $column_ids: [String!], $values: [String]!) {
+  items_page_by_column_values(board_id: $board_id, limit: 5, columns: [{column_id: $column_id, column_values: $values}]) {
+    items {
+      id
+      name
+      column_values(ids: $column_ids) {
+        id
+        text
+      }
+    }
+  }
+}
+"""
+
+_Q_BOARD_LAST_UPDATED = """
+query ($board_id: [ID!]) {
+  boards(ids: $board_id) {
+    items_count
+    items_page(limit: 1, query_params: {order_by: [{column_id: "__last_updated__", direction: desc}]}) {
+      items {
+        updated_at
+      }
+    }
+  }
+}
+"""
 
-def send_notification_to_monday(user_id: int, target_id: str, target_type: str, text: str) -> bool:
+# A legacy board scan: (phone index, newest item updated_at, board items_count).
+_BoardScan = Tuple[Dict[str, Tuple[str, str]], Optional[str], Optional[int]]
+
+_Q_UPDATE = """
+mutation ($item_id: ID!, $body: String!) {
+  create_update(item_id: $item_id, body: $body) {
+    id
+  }
+}
+"""
+
+@lru_cache(maxsize=None)
+def _notify_batch_query(count: int) -> str:
+    """Build (once per user count) a mutation with one aliased create_notification per user."""
+    var_defs = ["$target_id: ID!", "$target_type: NotificationTargetType!", "$text: String!"]
+    fields = []
+    for index in range(count):
+        var_defs.append(f"$u{index}: ID!")
+        fields.append(
+            f"n{index}: create_notification(user_id: $u{index}, target_id: $target_id, "
+            f"target_type: $target_type, text: $text) {{ id }}"
+        )
+    return "mutation (%s) {\n  %s\n}" % (", ".join(var_defs), "\n  ".join(fields))
+
+
+@lru_cache(maxsize=1)
+def _monday_key() -> str:
+    """MONDAY_API_KEY, read once until _refresh_env()."""
+    return os.environ.get("MONDAY_API_KEY", "")
+
+
+@lru_cache(maxsize=1)
+def _get_headers() -> Dict[str, str]:
+    """Return the Monday auth header, built once until _refresh_env()."""
+    return {"Authorization": _monday_key()}
+
+
+@lru_cache(maxsize=1)
+def _board_cfg() -> Tuple[Optional[str], Optional[str], bool]:
+    """(MONDAY_CONTACT_BOARD_ID, MONDAY_PHONE_COLUMN_ID, MONDAY_LEGACY_SCAN enabled), read once."""
+    return (
+        os.environ.get("MONDAY_CONTACT_BOARD_ID"),
+        os.environ.get("MONDAY_PHONE_COLUMN_ID"),
+        os.environ.get("MONDAY_LEGACY_SCAN") == "1",
+    )
+
+
+@lru_cache(maxsize=1)
+def _twilio_cfg() -> Tuple[Optional[str], Optional[str]]:
+    """(TWILIO_AUTH_TOKEN, TWILIO_WEBHOOK_URL), read once until _refresh_env()."""
+    return os.environ.get("TWILIO_AUTH_TOKEN"), os.environ.get("TWILIO_WEBHOOK_URL")
+
+
+@lru_cache(maxsize=1)
+def _background_worker_enabled() -> bool:
+    """BACKGROUND_WORKER == "1". Read once when process state is created; not reloadable."""
+    return os.environ.get("BACKGROUND_WORKER") == "1"
+
+
+def _refresh_env(*_signal_args: Any) -> None:
+    """Re-read cached env config on next use; also usable as a SIGHUP handler."""
+    for cached in (
+        _monday_key,
+        _get_headers,
+        _board_cfg,
+        _twilio_cfg,
+        get_monday_user_ids,
+        get_monday_user_id_strs,
+        get_contact_cache_ttl,
+    ):
+        cached.cache_clear()
+    # Expire and drop the saved board scan without taking the lock: a signal
+    # handler must not block on it, and each assignment is atomic on its own.
+    _contact_cache["expires"] = 0.0
+    _contact_cache["board_index"] = None
+    _contact_cache["board_updated_at"] = None
+    _contact_cache["board_items_count"] = None
+    logger.info("Environment configuration reloaded")
+
+
+def configure_logging() -> None:
+    """Install the INFO-level root handler once per process (no-op if already configured)."""
+    global _logging_configured
+    if not _logging_configured:
+        logging.basicConfig(level=logging.INFO)
+        _logging_configured = True
+
+
+def _get_state() -> Dict[str, Any]:
+    """Return the lazily-initialized process state, creating it on the first call."""
+    if _state:
+        return _state
+    with _state_lock:
+        if not _state:
+            configure_logging()
+
+            # Shared keep-alive session so consecutive Monday calls reuse the TLS connection.
+            session = requests.Session()
+            session.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=64, max_retries=0))
+            session.headers.update({"Content-Type": "application/json"})
+
+            # Long-lived deployments can set BACKGROUND_WORKER=1 to acknowledge Twilio
+            # immediately and process in a daemon thread. Serverless (Vercel) freezes the
+            # process after the response, so the default stays inline.
+            background_worker = _background_worker_enabled()
+            jobs: "queue.Queue[Tuple[str, str]]" = queue.Queue()
+            if background_worker:
+                threading.Thread(target=_sms_worker, args=(jobs,), name="sms-worker", daemon=True).start()
+
+            _state.update(
+                session=session,
+                # Worker pool for independent Monday calls; the session pool is sized to match.
+                executor=ThreadPoolExecutor(max_workers=8, thread_name_prefix="monday"),
+                background_worker=background_worker,
+                jobs=jobs,
+            )
+    return _state
+
+
+def _json_dumps(payload: Dict[str, Any]) -> bytes:
+    """Encode a request body, preferring orjson when available."""
+    if orjson is not None:
+        return orjson.dumps(payload)
+    return json.dumps(payload).encode("utf-8")
+
+
+def _json_loads(content: bytes) -> Any:
+    """Decode a response body, preferring orjson when available."""
+    if orjson is not None:
+        return orjson.loads(content)
+    return json.loads(content)
+
+
+def _retry_delay(attempt: int, base: float, cap: float, retry_after: Optional[str] = None) -> float:
+    """Exponential backoff with jitter, deferring to a numeric Retry-After header."""
+    if retry_after:
+        try:
+            return min(cap, float(retry_after))
+        except ValueError:
+            pass
+    return min(cap, base * 2 ** attempt) * (1 + random.random() * 0.5)
+
+
+def _send_monday(
+    query: str,
+    variables: Dict[str, Any],
+    *,
+    mutation: bool = False,
+    stream: bool = False,
+    max_retries: int = 3,
+    base: float = 1.0,
+    cap: float = 30.0,
+    budget: float = MONDAY_CALL_BUDGET,
+) -> Tuple[Optional[requests.Response], bool]:
+    """POST a GraphQL document to Monday with bounded retries.
+
+    Queries are retried on connection failures, timeouts, 429 and 5xx. Mutations
+    are only retried when Monday can't have applied them (connection failures
+    and 429), so a slow or failing Monday never gets the same update twice.
+    Retries stop once ``budget`` seconds have been spent on the call.
+
+    Returns ``(response, reached)``: the 2xx response (body unread when
+    ``stream`` is set) or None, and whether any attempt may have been applied
+    by Monday (a 2xx, read timeout or 5xx was seen).
+    """
+    headers = _get_headers()
+    deadline = time.monotonic() + budget
+    reached = False
+
+    for attempt in range(max_retries + 1):
+        retry_after = None
+        retryable = True
+        remaining = deadline - time.monotonic()
+        try:
+            resp = _get_state()["session"].post(
+                MONDAY_API_URL,
+                data=_json_dumps({"query": query, "variables": variables}),
+                headers=headers,
+                timeout=min(MONDAY_REQUEST_TIMEOUT, remaining),
+                stream=stream,
+            )
+        except requests.ConnectionError as exc:  # includes ConnectTimeout: nothing was sent
+            logger.warning("Monday request failed (attempt %d): %s", attempt + 1, exc)
+        except requests.Timeout as exc:
+            logger.warning("Monday request timed out (attempt %d): %s", attempt + 1, exc)
+            reached = True
+            retryable = not mutation
+        else:
+            if resp.status_code == 429:
+                logger.warning("Monday rate-limited the request (attempt %d)", attempt + 1)
+                retry_after = resp.headers.get("Retry-After")
+                resp.close()
+            elif resp.status_code >= 500:
+                logger.warning("Monday returned %s (attempt %d)", resp.status_code, attempt + 1)
+                retry_after = resp.headers.get("Retry-After")
+                resp.close()
+                reached = True
+                retryable = not mutation
+            elif resp.status_code >= 400:
+                logger.error("Monday rejected request with %s: %s", resp.status_code, resp.text[:500])
+                return None, reached
+            else:
+                return resp, True
+
+        if not retryable:
+            logger.error("Not retrying Monday mutation that may already have been applied")
+            return None, reached
+        if attempt < max_retries:
+            delay = _retry_delay(attempt, base, cap, retry_after)
+            if time.monotonic() + delay >= deadline:
+                break
+            time.sleep(delay)
+
+    logger.error("Giving up on Monday request after %d attempts", attempt + 1)
+    return None, reached
+
+
+def _decode_monday(resp: requests.Response) -> Optional[Dict[str, Any]]:
+    """Decode a Monday JSON payload, or None (logged) if the body isn't JSON."""
+    try:
+        return _json_loads(resp.content)
+    except ValueError:
+        logger.error("Monday returned a non-JSON response: %s", resp.text[:500])
+        return None
+
+
+def _post_monday(query: str, variables: Dict[str, Any], **retry_kwargs: Any) -> Optional[Dict[str, Any]]:
+    """Send a GraphQL document and decode the JSON payload (callers still check ``errors``)."""
+    resp, _ = _send_monday(query, variables, **retry_kwargs)
+    if resp is None:
+        return None
+    return _decode_monday(resp)
+
+
+def send_notification_to_monday(user_id: str, target_id: str, target_type: str, text: str) -> bool:
     """Send a notification to a Monday user (fallback when no contact item)."""
-    query = """
-            mutation ($user_id: ID!, $target_id: ID!, $target_type: NotificationTargetType!, $text: String!) {
-            create_notification(user_id: $user_id, target_id: $target_id, target_type: $target_type, text: $text) {
-                id
-            }
-            }
-            """
     variables = {
-        "user_id": str(user_id),
-        "target_id": str(target_id),
+        "user_id": user_id,
+        "target_id": target_id,
         "target_type": target_type,
         "text": text,
     }
-    monday_api_key = os.environ.get("MONDAY_API_KEY")
-    headers = {"Authorization": monday_api_key, "Content-Type": "application/json"}
+    logger.info("Posting fallback notification with variables: %s", variables)
+    data = _post_monday(_Q_NOTIFY, variables, mutation=True)
+    if data is None:
+        return False
+    if "errors" in data:
+        logger.error("Monday notification failed: %s", data["errors"])
+        return False
+    logger.info("Notification sent to user %s", user_id)
+    return True
 
-    try:
-        logging.info("Posting fallback notification with variables: %s", variables)
-        resp = requests.post(
-            MONDAY_API_URL,
-            json={"query": query, "variables": variables},
-            headers=headers,
-            timeout=10,
-        )
-        data = resp.json()
-        if "errors" in data:
-            logging.error("Monday notification failed: %s", data["errors"])
-            return False
-        logging.info("Notification sent to user %s", user_id)
+
+def send_notifications_to_monday(user_ids: List[str], target_id: str, target_type: str, text: str) -> bool:
+    """Notify every user in one request using an aliased multi-mutation document."""
+    if not user_ids:
         return True
-    except Exception as exc:
-        logging.exception("Failed to send Monday notification: %s", exc)
+
+    variables = {"target_id": target_id, "target_type": target_type, "text": text}
+    for index, user_id in enumerate(user_ids):
+        variables[f"u{index}"] = user_id
+
+    logger.info("Posting batched notification to %d users for %s %s", len(user_ids), target_type, target_id)
+    resp, reached = _send_monday(_notify_batch_query(len(user_ids)), variables, mutation=True)
+    if resp is None and reached:
+        # Monday may have applied the batch (timeout/5xx); resending could notify users twice.
+        logger.error("Batched Monday notification failed after reaching Monday; not resending")
         return False
+    if resp is None:
+        # The batch was never accepted (connection failure, 429, 4xx); fall back to one call per user.
+        logger.error("Batched Monday notification failed, sending individually")
+        results = list(
+            _get_state()["executor"].map(
+                lambda user_id: send_notification_to_monday(user_id, target_id, target_type, text),
+                user_ids,
+            )
+        )
+        return all(results)
 
+    data = _decode_monday(resp)
+    if data is None:
+        return False
+    if "errors" in data:
+        # Partial success is possible here, so don't resend and risk duplicates.
+        logger.error("Monday batched notification failed: %s", data["errors"])
+        return False
+    logger.info("Notifications sent to users %s", user_ids)
+    return True
 
+
+@lru_cache(maxsize=1)
 def get_monday_user_ids() -> List[int]:
-    """Read MONDAY_USER_IDS (comma-separated) or fallback to MONDAY_USER_ID."""
-    ids_value = os.environ.get("MONDAY_USER_IDS")
+    """Read MONDAY_USER_IDS (comma-separated) or fallback to MONDAY_USER_ID.
+
+    Parsed once; call _refresh_env() to pick up changes.
+    """
+    return _parse_monday_user_ids(os.environ.get("MONDAY_USER_IDS"), os.environ.get("MONDAY_USER_ID"))
+
+
+@lru_cache(maxsize=1)
+def get_monday_user_id_strs() -> List[str]:
+    """The configured user ids as strings (GraphQL ID variables), built once."""
+    return [str(user_id) for user_id in get_monday_user_ids()]
+
+
+def _parse_monday_user_ids(ids_value: Optional[str], single_user_id: Optional[str]) -> List[int]:
+    """Parse the user id env values, preferring the comma-separated list."""
     user_ids: List[int] = []
 
     if ids_value:
@@ -64,17 +444,16 @@ def get_monday_user_ids() -> List[int]:
             try:
                 user_ids.append(int(candidate))
             except ValueError:
-                logging.error("Invalid MONDAY_USER_IDS entry: %s", candidate)
+                logger.error("Invalid MONDAY_USER_IDS entry: %s", candidate)
 
     if user_ids:
         return user_ids
 
-    single_user_id = os.environ.get("MONDAY_USER_ID")
     if single_user_id:
         try:
             return [int(single_user_id)]
         except ValueError:
-            logging.error("MONDAY_USER_ID invalid: %s", single_user_id)
+            logger.error("MONDAY_USER_ID invalid: %s", single_user_id)
 
     return []
 
@@ -83,88 +462,295 @@ def normalize_phone_number(number: Optional[str]) -> str:
     """Strip to digits and normalize leading country code for comparisons."""
     if not number:
         return ""
-    digits = re.sub(r"\D+", "", number)
+    digits = _NON_DIGITS.sub("", number)
     if len(digits) == 11 and digits.startswith("1"):
         digits = digits[1:]
     return digits
 
 
-def lookup_contact_by_phone(phone_number: str) -> Optional[Tuple[str, str]]:
-    """Fetch the Monday contact name and item ID matching the provided phone number."""
-    normalized = normalize_phone_number(phone_number)
-    if not normalized:
-        logging.info("Skipping contact lookup: phone number missing/invalid")
+@lru_cache(maxsize=1)
+def get_contact_cache_ttl() -> float:
+    """Read MONDAY_CONTACT_CACHE_TTL (seconds) or fall back to the default."""
+    raw = os.environ.get("MONDAY_CONTACT_CACHE_TTL")
+    if raw:
+        try:
+            return float(raw)
+        except ValueError:
+            logger.error("MONDAY_CONTACT_CACHE_TTL invalid: %s", raw)
+    return DEFAULT_CONTACT_CACHE_TTL
+
+
+def _invalidate_contact_cache() -> None:
+    """Drop the cached contact index (and last board scan) so the next lookup goes back to Monday."""
+    _expire_contact_cache()
+    _contact_cache["board_index"] = None
+    _contact_cache["board_updated_at"] = None
+    _contact_cache["board_items_count"] = None
+
+
+def _expire_contact_cache() -> None:
+    """Clear the live index but keep the last board scan for revalidation."""
+    _contact_cache["expires"] = 0.0
+    _contact_cache["by_phone"] = {}
+    _contact_cache["scanned"] = False
+
+
+def _ensure_contact_cache_fresh() -> None:
+    """Reset the contact cache if its TTL has lapsed. Caller holds the lock."""
+    now = time.monotonic()
+    if now >= _contact_cache["expires"]:
+        _expire_contact_cache()
+        _contact_cache["expires"] = now + get_contact_cache_ttl()
+
+
+def phone_lookup_variants(normalized: str) -> List[str]:
+    """Spellings a phone column may hold for a normalized number, for exact server-side matching."""
+    variants = [normalized]
+    if len(normalized) == 10:
+        area, prefix, line = normalized[:3], normalized[3:6], normalized[6:]
+        variants += [
+            f"+1{normalized}",
+            f"1{normalized}",
+            f"({area}) {prefix}-{line}",
+            f"{area}-{prefix}-{line}",
+            f"+1 {area} {prefix} {line}",
+        ]
+    else:
+        variants.append(f"+{normalized}")
+    return variants
+
+
+def _query_contacts_by_phone(board_id: str, phone_column_id: str, normalized: str) -> Optional[List[Dict[str, Any]]]:
+    """Ask Monday for the items whose phone column matches; None if the request failed."""
+    variables = {
+        "board_id": board_id,
+        "column_id": phone_column_id,
+        "column_ids": [phone_column_id],
+        "values": phone_lookup_variants(normalized),
+    }
+
+    data = _post_monday(_Q_LOOKUP_BY_PHONE, variables)
+    if data is None:
         return None
 
-    board_id = os.environ.get("MONDAY_CONTACT_BOARD_ID")
-    phone_column_id = os.environ.get("MONDAY_PHONE_COLUMN_ID")
-    if not board_id or not phone_column_id:
-        logging.info(
-            "Skipping contact lookup: MONDAY_CONTACT_BOARD_ID (%s) or MONDAY_PHONE_COLUMN_ID (%s) missing",
-            bool(board_id),
-            bool(phone_column_id),
-        )
+    if "errors" in data:
+        logger.error("Contact lookup failed: %s", data["errors"])
         return None
 
-    query = """
-            query ($board_id: [ID!], $limit: Int!, $column_ids: [String!]) {
-            boards(ids: $board_id) {
-                items_page(limit: $limit) {
-                items {
-                    id
-                    name
-                    column_values(ids: $column_ids) {
-                    id
-                    text
-                    }
-                }
-                }
-            }
-            }
-            """
+    page = (data.get("data") or {}).get("items_page_by_column_values") or {}
+    return page.get("items", [])
+
+
+def _index_contact_items(
+    items: List[Dict[str, Any]], by_phone: Dict[str, Tuple[str, str]]
+) -> Dict[str, Tuple[str, str]]:
+    """Add each item's phone column values to by_phone, normalizing every value exactly once."""
+    for item in items:
+        entry = (item.get("name"), item.get("id"))
+        for column in item.get("column_values", []):
+            text = column.get("text")
+            if not text:
+                continue
+            current = normalize_phone_number(text)
+            if current and current not in by_phone:
+                # First match wins, mirroring the original linear scan.
+                by_phone[current] = entry
+    return by_phone
+
+
+def _newest_updated_at(current: Optional[str], item: Dict[str, Any]) -> Optional[str]:
+    """Return the later of ``current`` and the item's updated_at (ISO timestamps compare as strings)."""
+    item_updated_at = item.get("updated_at")
+    if item_updated_at and (current is None or item_updated_at > current):
+        return item_updated_at
+    return current
+
+
+def _fetch_contact_index(board_id: str, phone_column_id: str) -> Optional[_BoardScan]:
+    """Fetch the whole contact board (legacy scan) and index its items by normalized phone number.
+
+    Returns the index together with the newest item ``updated_at`` and the board's ``items_count``.
+    """
     variables = {
         "board_id": board_id,
         "limit": MONDAY_ITEMS_PAGE_LIMIT,
         "column_ids": [phone_column_id],
     }
 
-    monday_api_key = os.environ.get("MONDAY_API_KEY")
-    headers = {"Authorization": monday_api_key, "Content-Type": "application/json"}
+    if ijson is not None:
+        result = _stream_contact_index(variables)
+    else:
+        data = _post_monday(_Q_LOOKUP, variables)
+        if data is None:
+            return None
+
+        if "errors" in data:
+            logger.error("Contact lookup failed: %s", data["errors"])
+            return None
+
+        by_phone: Dict[str, Tuple[str, str]] = {}
+        updated_at = items_count = None
+        for board in data.get("data", {}).get("boards", []):
+            items_count = board.get("items_count")
+            for item in board.get("items_page", {}).get("items", []):
+                _index_contact_items([item], by_phone)
+                updated_at = _newest_updated_at(updated_at, item)
+        result = by_phone, updated_at, items_count
+
+    if result is not None:
+        logger.info("Loaded %d contact phone numbers from board %s", len(result[0]), board_id)
+    return result
+
+
+def _fetch_board_version(board_id: str) -> Optional[Tuple[Optional[str], Optional[int]]]:
+    """Return (newest item updated_at, items_count) via a one-row query, or None on failure."""
+    data = _post_monday(_Q_BOARD_LAST_UPDATED, {"board_id": board_id})
+    if data is None:
+        return None
+    if "errors" in data:
+        logger.error("Board freshness check failed: %s", data["errors"])
+        return None
+    for board in data.get("data", {}).get("boards", []):
+        updated_at = None
+        for item in board.get("items_page", {}).get("items", []):
+            updated_at = _newest_updated_at(updated_at, item)
+        return updated_at, board.get("items_count")
+    return None
+
+
+def _load_board_index(board_id: str, phone_column_id: str, previous: Optional[_BoardScan]) -> Optional[_BoardScan]:
+    """Return the full-board scan, reusing ``previous`` if the board is unchanged.
+
+    The board counts as unchanged when both its newest item updated_at and its
+    items_count match; the count catches deletions, which don't bump updated_at.
+    Does network I/O; call it without holding _contact_cache_lock.
+    """
+    if previous is not None and previous[1] and previous[2] is not None:
+        latest = _fetch_board_version(board_id)
+        if latest is not None and latest == previous[1:]:
+            logger.info("Contact board %s unchanged since %s; reusing last scan", board_id, latest[0])
+            return previous
 
+    return _fetch_contact_index(board_id, phone_column_id)
+
+
+def _stream_contact_index(variables: Dict[str, Any]) -> Optional[_BoardScan]:
+    """Index the board scan item by item with ijson so the full response is never materialized."""
+    resp, _ = _send_monday(_Q_LOOKUP, variables, stream=True)
+    if resp is None:
+        return None
+
+    saw_errors = False
+    items_count = None
+
+    def watch(events):
+        # Note top-level errors and the board items_count as the events stream past.
+        nonlocal saw_errors, items_count
+        for prefix, event, value in events:
+            if prefix == "errors":
+                saw_errors = True
+            elif prefix == "data.boards.item.items_count" and event == "number":
+                items_count = int(value)
+            yield prefix, event, value
+
+    by_phone: Dict[str, Tuple[str, str]] = {}
+    updated_at = None
     try:
-        resp = requests.post(
-            MONDAY_API_URL,
-            json={"query": query, "variables": variables},
-            headers=headers,
-            timeout=10,
+        resp.raw.decode_content = True
+        events = watch(ijson.parse(resp.raw))
+        for item in ijson.items(events, "data.boards.item.items_page.items.item"):
+            _index_contact_items([item], by_phone)
+            updated_at = _newest_updated_at(updated_at, item)
+        # Drain the rest so an "errors" key after "data" is still noticed.
+        for _ in events:
+            pass
+    except ijson.JSONError as exc:
+        logger.error("Contact lookup returned malformed JSON: %s", exc)
+        return None
+    except (urllib3.exceptions.HTTPError, requests.RequestException) as exc:
+        # The body is read after _send_monday returns, so read timeouts and dropped
+        # connections surface here rather than in its retry loop.
+        logger.error("Contact lookup stream failed mid-read: %s", exc)
+        return None
+    finally:
+        resp.close()
+
+    if saw_errors:
+        logger.error("Contact lookup failed: Monday returned errors")
+        return None
+    return by_phone, updated_at, items_count
+
+
+def lookup_contact_by_phone(phone_number: str) -> Optional[Tuple[str, str]]:
+    """Fetch the Monday contact name and item ID matching the provided phone number."""
+    normalized = normalize_phone_number(phone_number)
+    if not normalized:
+        logger.info("Skipping contact lookup: phone number missing/invalid")
+        return None
+
+    board_id, phone_column_id, legacy_scan = _board_cfg()
+    if not board_id or not phone_column_id:
+        logger.info(
+            "Skipping contact lookup: MONDAY_CONTACT_BOARD_ID (%s) or MONDAY_PHONE_COLUMN_ID (%s) missing",
+            bool(board_id),
+            bool(phone_column_id),
         )
-        data = resp.json()
+        return None
 
-        if "errors" in data:
-            logging.error("Contact lookup failed: %s", data["errors"])
+    with _contact_cache_lock:
+        _ensure_contact_cache_fresh()
+        match = _contact_cache["by_phone"].get(normalized)
+
+    if not match:
+        items = _query_contacts_by_phone(board_id, phone_column_id, normalized)
+        if items is None:
+            with _contact_cache_lock:
+                _invalidate_contact_cache()
             return None
 
-        boards = data.get("data", {}).get("boards", [])
-        for board in boards:
-            items_page = board.get("items_page", {})
-            for item in items_page.get("items", []):
-                col_values = item.get("column_values", [])
-                for column in col_values:
-                    current = normalize_phone_number(column.get("text"))
-                    if current and current == normalized:
-                        name = item.get("name")
-                        item_id = item.get("id")
-                        logging.info(
-                            "Matched contact %s (item %s) for phone %s",
-                            name,
-                            item_id,
-                            phone_number,
-                        )
-                        return name, item_id
-    except Exception as exc:
-        logging.exception("Contact lookup request failed: %s", exc)
-
-    logging.info("No contact found on board %s for phone %s", board_id, phone_number)
+        with _contact_cache_lock:
+            _ensure_contact_cache_fresh()
+            match = _index_contact_items(items, _contact_cache["by_phone"]).get(normalized)
+
+    if not match and legacy_scan:
+        # One scan at a time; concurrent lookups and cache hits only wait on the
+        # short _contact_cache_lock sections, never on the scan's network I/O.
+        with _contact_refresh_lock:
+            with _contact_cache_lock:
+                _ensure_contact_cache_fresh()
+                scanned = _contact_cache["scanned"]
+                previous = None
+                if _contact_cache["board_index"] is not None:
+                    previous = (
+                        _contact_cache["board_index"],
+                        _contact_cache["board_updated_at"],
+                        _contact_cache["board_items_count"],
+                    )
+
+            board = None
+            if not scanned:
+                board = _load_board_index(board_id, phone_column_id, previous)
+
+            with _contact_cache_lock:
+                if not scanned:
+                    if board is None:
+                        _invalidate_contact_cache()
+                        return None
+                    (
+                        _contact_cache["board_index"],
+                        _contact_cache["board_updated_at"],
+                        _contact_cache["board_items_count"],
+                    ) = board
+                    # Copy so server-side lookups added later don't leak into the saved scan.
+                    _contact_cache["by_phone"] = dict(board[0])
+                    _contact_cache["scanned"] = True
+                match = _contact_cache["by_phone"].get(normalized)
+
+    if match:
+        logger.info("Matched contact %s (item %s) for phone %s", match[0], match[1], phone_number)
+        return match
+
+    logger.info("No contact found on board %s for phone %s", board_id, phone_number)
     return None
 
 
@@ -173,118 +759,165 @@ def create_update_for_item(item_id: str, sender_label: str, message: str) -> Opt
     text_html = html.escape(message).replace("\n", "<br/>")
     body = f"<p><strong>New SMS from {html.escape(sender_label)}</strong></p><p>{text_html}</p>"
 
-    query = """
-mutation ($item_id: ID!, $body: String!) {
-  create_update(item_id: $item_id, body: $body) {
-    id
-  }
-}
-"""
     variables = {"item_id": item_id, "body": body}
-    monday_api_key = os.environ.get("MONDAY_API_KEY")
-    headers = {"Authorization": monday_api_key, "Content-Type": "application/json"}
+    logger.info("Posting update to Monday item %s", item_id)
+    data = _post_monday(_Q_UPDATE, variables, mutation=True)
+    if data is None:
+        return None
+    if "errors" in data:
+        logger.error("Failed to create update: %s", data["errors"])
+        return None
 
-    try:
-        logging.info("Posting update to Monday item %s", item_id)
-        response = requests.post(
-            MONDAY_API_URL,
-            json={"query": query, "variables": variables},
-            headers=headers,
-            timeout=10,
+    update_id = data.get("data", {}).get("create_update", {}).get("id")
+    logger.info("Created Monday update %s for item %s", update_id, item_id)
+    return update_id
+
+
+def process_sms(from_number: str, body: str) -> None:
+    """Look up the sender, post the SMS as an update and notify the configured users."""
+    user_ids = get_monday_user_id_strs()
+    if not user_ids:
+        logger.error("No valid MONDAY user IDs configured (MONDAY_USER_IDS or MONDAY_USER_ID)")
+        return
+
+    contact_match = lookup_contact_by_phone(from_number)
+    contact_name = contact_item_id = None
+    if contact_match:
+        contact_name, contact_item_id = contact_match
+
+    sender_label = f"{contact_name} ({from_number})" if contact_name else from_number
+
+    # Prepare notification
+    notification_text = f"New SMS from {sender_label}:\n\n{body}"
+
+    if not contact_item_id:
+        logger.info(
+            "No contact match for %s; ignoring SMS for Monday workflow",
+            from_number,
         )
-        data = response.json()
-        if "errors" in data:
-            logging.error("Failed to create update: %s", data["errors"])
-            return None
+        return
 
-        update_id = data.get("data", {}).get("create_update", {}).get("id")
-        logging.info("Created Monday update %s for item %s", update_id, item_id)
-        return update_id
-    except Exception as exc:
-        logging.exception("Error while creating Monday update: %s", exc)
-        return None
+    update_id = create_update_for_item(contact_item_id, sender_label, body)
+    if not update_id:
+        logger.error("Failed to create update for item %s", contact_item_id)
+        return
+
+    logger.info(
+        "Sending update-linked notification to users %s for update %s",
+        user_ids,
+        update_id,
+    )
+    send_notifications_to_monday(user_ids, update_id, "Post", notification_text)
+
+
+def _sms_worker(jobs: "queue.Queue[Tuple[str, str]]") -> None:
+    """Drain queued SMS jobs so Monday latency never delays the Twilio response."""
+    while True:
+        from_number, body = jobs.get()
+        try:
+            process_sms(from_number, body)
+        except Exception as exc:
+            logger.exception("Error processing queued SMS: %s", exc)
+        finally:
+            jobs.task_done()
+
+
+def twilio_signature(auth_token: str, url: str, params: Dict[str, List[str]]) -> str:
+    """Compute Twilio's X-Twilio-Signature: base64 HMAC-SHA1 over the URL plus sorted params."""
+    payload = url + "".join(key + value for key in sorted(params) for value in sorted(params[key]))
+    digest = hmac.new(auth_token.encode("utf-8"), payload.encode("utf-8"), hashlib.sha1).digest()
+    return base64.b64encode(digest).decode("ascii")
+
+
+def is_valid_twilio_request() -> bool:
+    """Check the request signature when TWILIO_AUTH_TOKEN is configured (always valid otherwise)."""
+    auth_token, webhook_url = _twilio_cfg()
+    if not auth_token:
+        return True
+
+    provided = request.headers.get("X-Twilio-Signature", "")
+    if not provided:
+        return False
+    # Behind Vercel's proxy request.url may not match what Twilio signed; allow an override.
+    url = webhook_url or request.url
+    expected = twilio_signature(auth_token, url, request.form.to_dict(flat=False))
+    return hmac.compare_digest(expected, provided)
 
 
 @app.route("/sms", methods=["POST"])
 def receive_sms():
     """Receive Twilio SMS webhook (form-encoded)."""
 
-    logging.info("MONDAY_USER_ID present at request time: %s", bool(os.environ.get("MONDAY_USER_ID")))
-    logging.info("MONDAY_USER_IDS present at request time: %s", bool(os.environ.get("MONDAY_USER_IDS")))
-    
     try:
+        state = _get_state()
+
+        # Cheap header checks first so junk never reaches Werkzeug's form parser.
+        if (
+            request.content_length is None
+            or request.content_length > MAX_WEBHOOK_BYTES
+            or request.mimetype != "application/x-www-form-urlencoded"
+        ):
+            logger.warning(
+                "Rejecting /sms request: content type %s, length %s",
+                request.mimetype,
+                request.content_length,
+            )
+            return ("", 400)
+
+        if not is_valid_twilio_request():
+            logger.warning("Rejecting /sms request with missing or invalid X-Twilio-Signature")
+            return ("", 403)
+
         # Extract from form data (Twilio uses application/x-www-form-urlencoded)
         from_number = request.form.get("From")
         body = request.form.get("Body")
         
-        logging.info(f"Received SMS from {from_number}: {body}")
+        logger.info("Received SMS from %s: %s", from_number, body)
 
         if not from_number or not body:
-            logging.warning("Missing From or Body in webhook")
-            return ("", 200)
-
-        contact_match = lookup_contact_by_phone(from_number)
-        contact_name = contact_item_id = None
-        if contact_match:
-            contact_name, contact_item_id = contact_match
-
-        sender_label = f"{contact_name} ({from_number})" if contact_name else from_number
-
-        # Prepare notification
-        notification_text = f"New SMS from {sender_label}:\n\n{body}"
-
-        user_ids = get_monday_user_ids()
-        if not user_ids:
-            logging.error("No valid MONDAY user IDs configured (MONDAY_USER_IDS or MONDAY_USER_ID)")
+            logger.warning("Missing From or Body in webhook")
             return ("", 200)
 
-        if not contact_item_id:
-            logging.info(
-                "No contact match for %s; ignoring SMS for Monday workflow",
-                from_number,
-            )
-            return ("", 200)
-
-        update_id = create_update_for_item(contact_item_id, sender_label, body)
-        if not update_id:
-            logging.error("Failed to create update for item %s", contact_item_id)
-            return ("", 200)
-
-        for user_id in user_ids:
-            logging.info(
-                "Sending update-linked notification to user %s for update %s",
-                user_id,
-                update_id,
-            )
-            send_notification_to_monday(
-                user_id,
-                update_id,
-                "Post",
-                notification_text,
-            )
+        if state["background_worker"]:
+            state["jobs"].put((from_number, body))
+        else:
+            process_sms(from_number, body)
 
         return ("", 200)
 
     except Exception as e:
-        logging.exception(f"Error in /sms: {e}")
+        logger.exception("Error in /sms: %s", e)
         return ("", 200)
 
 
+_env_presence_logged = False
+
+# Long-lived deployments can `kill -HUP` the process to re-read env config.
+if hasattr(signal, "SIGHUP"):
+    try:
+        signal.signal(signal.SIGHUP, _refresh_env)
+    except ValueError:  # not imported from the main thread
+        pass
+
+
 @app.route("/", methods=["GET"])
 def health():
-    # Temporary debug: log presence (but never the value) of important env vars
-    api_present = bool(os.environ.get("MONDAY_API_KEY"))
-    user_present = bool(os.environ.get("MONDAY_USER_ID"))
-    users_present = bool(os.environ.get("MONDAY_USER_IDS"))
-    board_present = bool(os.environ.get("MONDAY_CONTACT_BOARD_ID"))
-    phone_column_present = bool(os.environ.get("MONDAY_PHONE_COLUMN_ID"))
-    logging.info("MONDAY_API_KEY present at runtime: %s", api_present)
-    logging.info("MONDAY_USER_ID present at runtime: %s", user_present)
-    logging.info("MONDAY_USER_IDS present at runtime: %s", users_present)
-    logging.info("MONDAY_CONTACT_BOARD_ID present at runtime: %s", board_present)
-    logging.info("MONDAY_PHONE_COLUMN_ID present at runtime: %s", phone_column_present)
+    global _env_presence_logged
+    configure_logging()
+    if not _env_presence_logged:
+        # Log presence (but never the value) of important env vars, once per process.
+        _env_presence_logged = True
+        for name in (
+            "MONDAY_API_KEY",
+            "MONDAY_USER_ID",
+            "MONDAY_USER_IDS",
+            "MONDAY_CONTACT_BOARD_ID",
+            "MONDAY_PHONE_COLUMN_ID",
+        ):
+            logger.info("%s present at runtime: %s", name, bool(os.environ.get(name)))
     return ("Twilio -> Monday webhook running", 200)
 
 
 if __name__ == "__main__":
+    configure_logging()
     app.run(debug=True, port=5000)
@@ -6,6 +6,7 @@ Run this to verify the Vercel deployment is working and notifications are sent t
 
 import requests
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 # Your Vercel endpoint
@@ -39,42 +40,48 @@ test_cases = [
     }
 ]
 
-def run_test(test_case):
-    """Run a single test case."""
+def run_test(test_case, session=None):
+    """Run a single test case, printing its report as one block."""
     name = test_case["name"]
     payload = test_case["payload"]
+    http = session or requests
+    lines = []
     
-    print(f"\n{'='*60}")
-    print(f"Test: {name}")
-    print(f"{'='*60}")
-    print(f"Endpoint: {ENDPOINT_URL}")
-    print(f"Payload: {payload}")
-    print(f"-" * 60)
+    lines.append(f"\n{'='*60}")
+    lines.append(f"Test: {name}")
+    lines.append(f"{'='*60}")
+    lines.append(f"Endpoint: {ENDPOINT_URL}")
+    lines.append(f"Payload: {payload}")
+    lines.append(f"-" * 60)
     
     try:
-        response = requests.post(
+        response = http.post(
             ENDPOINT_URL,
             data=payload,
             headers={"Content-Type": "application/x-www-form-urlencoded"},
             timeout=10
         )
         
-        print(f"Status Code: {response.status_code}")
-        print(f"Response Headers: {dict(response.headers)}")
-        print(f"Response Body: {response.text if response.text else '(empty)'}")
+        lines.append(f"Status Code: {response.status_code}")
+        lines.append(f"Response Headers: {dict(response.headers)}")
+        lines.append(f"Response Body: {response.text if response.text else '(empty)'}")
         
         if response.status_code == 200:
-            print("✅ SUCCESS: Endpoint accepted the webhook")
+            lines.append("✅ SUCCESS: Endpoint accepted the webhook")
         else:
-            print(f"⚠️  WARNING: Unexpected status code {response.status_code}")
+            lines.append(f"⚠️  WARNING: Unexpected status code {response.status_code}")
         
-        return True
+        success = True
     except requests.RequestException as e:
-        print(f"❌ ERROR: {e}")
-        return False
+        lines.append(f"❌ ERROR: {e}")
+        success = False
     except Exception as e:
-        print(f"❌ UNEXPECTED ERROR: {e}")
-        return False
+        lines.append(f"❌ UNEXPECTED ERROR: {e}")
+        success = False
+
+    # Tests run concurrently; print the whole report at once so output doesn't interleave.
+    print("\n".join(lines))
+    return success
 
 def main():
     print(f"\n{'#'*60}")
@@ -83,10 +90,10 @@ def main():
     print(f"Testing endpoint: {ENDPOINT_URL}")
     print(f"Tests to run: {len(test_cases)}")
     
-    results = []
-    for test_case in test_cases:
-        success = run_test(test_case)
-        results.append((test_case["name"], success))
+    # Run the tests concurrently over one session (shared TLS to the Vercel endpoint).
+    with requests.Session() as session, ThreadPoolExecutor(max_workers=len(test_cases)) as ex:
+        successes = ex.map(lambda tc: run_test(tc, session), test_cases)
+        results = list(zip((tc["name"] for tc in test_cases), successes))
     
     # Summary
     print(f"\n{'='*60}")
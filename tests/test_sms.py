@@ -0,0 +1,398 @@
+import threading
+
+import pytest
+import requests
+import urllib3
+
+from api import sms
+
+
+# Example request from Twilio's webhook security docs.
+TWILIO_DOC_URL = "https://mycompany.com/myapp.php?foo=1&bar=2"
+TWILIO_DOC_PARAMS = {
+    "CallSid": ["CA1234567890ABCDE"],
+    "Caller": ["+12349013030"],
+    "Digits": ["1234"],
+    "From": ["+12349013030"],
+    "To": ["+18005551212"],
+}
+
+
+def test_twilio_signature_matches_documented_vector():
+    assert sms.twilio_signature("12345", TWILIO_DOC_URL, TWILIO_DOC_PARAMS) == "0/KCTR6DLpKmkAf8muzZqo1nDgQ="
+
+
+def test_twilio_signature_ignores_param_order():
+    reordered = dict(reversed(list(TWILIO_DOC_PARAMS.items())))
+    assert sms.twilio_signature("12345", TWILIO_DOC_URL, reordered) == "0/KCTR6DLpKmkAf8muzZqo1nDgQ="
+
+
+@pytest.fixture
+def signed_client(monkeypatch):
+    monkeypatch.setenv("TWILIO_AUTH_TOKEN", "12345")
+    monkeypatch.delenv("TWILIO_WEBHOOK_URL", raising=False)
+    sms._refresh_env()
+    processed = []
+    monkeypatch.setattr(sms, "process_sms", lambda from_number, body: processed.append((from_number, body)))
+    yield sms.app.test_client(), processed
+    monkeypatch.delenv("TWILIO_AUTH_TOKEN")
+    sms._refresh_env()
+
+
+def test_sms_accepts_valid_signature(signed_client):
+    client, processed = signed_client
+    form = {"From": "+15551234567", "Body": "hi"}
+    signature = sms.twilio_signature("12345", "http://localhost/sms", {k: [v] for k, v in form.items()})
+
+    resp = client.post("/sms", data=form, headers={"X-Twilio-Signature": signature})
+
+    assert resp.status_code == 200
+    assert processed == [("+15551234567", "hi")]
+
+
+def test_sms_rejects_bad_signature(signed_client):
+    client, processed = signed_client
+
+    resp = client.post("/sms", data={"From": "+15551234567", "Body": "hi"}, headers={"X-Twilio-Signature": "bogus"})
+
+    assert resp.status_code == 403
+    assert processed == []
+
+
+@pytest.mark.parametrize("value, expected", [("1", True), ("0", False), ("false", False), ("", False)])
+def test_background_worker_only_enabled_by_one(monkeypatch, value, expected):
+    monkeypatch.setenv("BACKGROUND_WORKER", value)
+    sms._background_worker_enabled.cache_clear()
+    try:
+        assert sms._background_worker_enabled() is expected
+    finally:
+        sms._background_worker_enabled.cache_clear()
+
+
+class FakeResponse:
+    def __init__(self, status_code=200, payload=b'{"data": {}}', headers=None):
+        self.status_code = status_code
+        self.content = payload
+        self.text = payload.decode()
+        self.headers = headers or {}
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def monday(monkeypatch):
+    """Stub the Monday session with scripted outcomes and a fake clock that sleeps advance."""
+    script = []
+    posts = []
+    clock = {"now": 1000.0}
+    sleeps = []
+
+    class FakeSession:
+        def post(self, url, data, **kwargs):
+            posts.append(data)
+            outcome = script.pop(0) if len(script) > 1 else script[0]
+            if isinstance(outcome, Exception):
+                raise outcome
+            return outcome
+
+    def fake_sleep(seconds):
+        sleeps.append(seconds)
+        clock["now"] += seconds
+
+    monkeypatch.setitem(sms._get_state(), "session", FakeSession())
+    monkeypatch.setattr(sms.time, "monotonic", lambda: clock["now"])
+    monkeypatch.setattr(sms.time, "sleep", fake_sleep)
+    monkeypatch.setattr(sms.random, "random", lambda: 0.0)
+    return script, posts, sleeps
+
+
+@pytest.mark.parametrize("outcome", [FakeResponse(503), requests.ReadTimeout("slow")])
+def test_update_mutation_not_retried_once_it_may_have_applied(monday, outcome):
+    script, posts, sleeps = monday
+    script.append(outcome)
+
+    assert sms.create_update_for_item("42", "Ann", "hi") is None
+    assert len(posts) == 1
+    assert sleeps == []
+
+
+@pytest.mark.parametrize("outcome", [FakeResponse(502), requests.ReadTimeout("slow"), FakeResponse(200, b"<html>")])
+def test_batched_notify_does_not_fall_back_once_it_may_have_applied(monday, outcome):
+    script, posts, _ = monday
+    script.append(outcome)
+
+    assert sms.send_notifications_to_monday(["1", "2", "3"], "555", "Post", "hi") is False
+    assert len(posts) == 1
+
+
+def test_batched_notify_falls_back_per_user_when_never_sent(monday):
+    script, posts, _ = monday
+    script.extend([requests.ConnectionError("refused")] * 4 + [FakeResponse(200)])
+
+    assert sms.send_notifications_to_monday(["1", "2", "3"], "555", "Post", "hi") is True
+    assert len(posts) == 4 + 3
+
+
+def test_mutation_retried_after_rate_limit_honoring_retry_after(monday):
+    script, posts, sleeps = monday
+    script.extend([
+        FakeResponse(429, headers={"Retry-After": "3"}),
+        FakeResponse(200, b'{"data": {"create_update": {"id": "9"}}}'),
+    ])
+
+    assert sms.create_update_for_item("42", "Ann", "hi") == "9"
+    assert len(posts) == 2
+    assert sleeps == [3.0]
+
+
+def test_mutation_retried_after_connection_error(monday):
+    script, posts, sleeps = monday
+    script.extend([requests.ConnectionError("refused"), FakeResponse(200, b'{"data": {"create_update": {"id": "9"}}}')])
+
+    assert sms.create_update_for_item("42", "Ann", "hi") == "9"
+    assert len(posts) == 2
+    assert sleeps == [1.0]
+
+
+def test_query_retried_on_5xx_until_max_retries(monday):
+    script, posts, sleeps = monday
+    script.append(FakeResponse(503))
+
+    assert sms._post_monday("query { me { id } }", {}) is None
+    assert len(posts) == 4
+    assert sleeps == [1.0, 2.0, 4.0]
+
+
+def test_query_retries_stop_at_call_budget(monday):
+    script, posts, sleeps = monday
+    script.append(FakeResponse(503))
+
+    # Backoff is 1s, 2s, then 4s; the third sleep would pass the 5s budget.
+    assert sms._post_monday("query { me { id } }", {}, budget=5.0) is None
+    assert len(posts) == 3
+    assert sleeps == [1.0, 2.0]
+
+
+@pytest.mark.parametrize(
+    "raw, expected",
+    [
+        ("+1 (555) 123-4567", "5551234567"),
+        ("555.123.4567", "5551234567"),
+        # Unicode decimal digits are kept as-is, as the baseline re.sub did.
+        ("+1 ５５５ 123 4567", "５５５1234567"),
+        ("+44 20 7946 0958", "442079460958"),
+        ("", ""),
+        (None, ""),
+    ],
+)
+def test_normalize_phone_number(raw, expected):
+    assert sms.normalize_phone_number(raw) == expected
+
+
+class FailingRaw:
+    """A response body that yields a partial document, then fails like a dropped stream."""
+
+    def __init__(self, error):
+        self.error = error
+        self.sent = False
+
+    def read(self, size=-1):
+        if not self.sent:
+            self.sent = True
+            return b'{"data": {"boards": [{"items_count": 2, "items_page": {"items": ['
+        raise self.error
+
+
+class StreamResponse:
+    def __init__(self, raw):
+        self.raw = raw
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.mark.parametrize(
+    "error",
+    [
+        urllib3.exceptions.ReadTimeoutError(None, "/v2", "read timed out"),
+        urllib3.exceptions.ProtocolError("connection broken"),
+        requests.ConnectionError("connection broken"),
+    ],
+)
+def test_stream_scan_returns_none_on_mid_stream_read_failure(monkeypatch, error):
+    pytest.importorskip("ijson")
+    resp = StreamResponse(FailingRaw(error))
+    monkeypatch.setattr(sms, "_send_monday", lambda query, variables, **kwargs: (resp, True))
+
+    assert sms._stream_contact_index({"board_id": "9", "limit": 500, "column_ids": ["phone"]}) is None
+    assert resp.closed
+
+
+class FakeBoard:
+    """Scripted contact board behind a stubbed _post_monday."""
+
+    def __init__(self):
+        self.items = [
+            {"id": "1", "name": "Ann", "updated_at": "2026-01-01T00:00:00Z", "column_values": [{"text": "(555) 123-4567"}]},
+            {"id": "2", "name": "Bob", "updated_at": "2026-02-01T00:00:00Z", "column_values": [{"text": "555-000-0000"}]},
+        ]
+        self.calls = []
+        self.fail = set()
+
+    def newest(self):
+        return max(item["updated_at"] for item in self.items)
+
+    def post(self, query, variables, **kwargs):
+        kind = {
+            sms._Q_LOOKUP_BY_PHONE: "by_phone",
+            sms._Q_BOARD_LAST_UPDATED: "freshness",
+            sms._Q_LOOKUP: "scan",
+        }[query]
+        self.calls.append(kind)
+        if kind in self.fail:
+            return {"errors": [{"message": "boom"}]}
+        if kind == "by_phone":
+            # Only the legacy scan knows these contacts, forcing the board-scan path.
+            return {"data": {"items_page_by_column_values": {"items": []}}}
+        items = self.items if kind == "scan" else [{"updated_at": self.newest()}]
+        return {"data": {"boards": [{"items_count": len(self.items), "items_page": {"items": items}}]}}
+
+
+@pytest.fixture
+def board(monkeypatch):
+    fake = FakeBoard()
+    clock = {"now": 1000.0}
+    monkeypatch.setenv("MONDAY_CONTACT_BOARD_ID", "9")
+    monkeypatch.setenv("MONDAY_PHONE_COLUMN_ID", "phone")
+    monkeypatch.setenv("MONDAY_LEGACY_SCAN", "1")
+    monkeypatch.setenv("MONDAY_CONTACT_CACHE_TTL", "60")
+    monkeypatch.setattr(sms, "_post_monday", fake.post)
+    monkeypatch.setattr(sms, "ijson", None)
+    monkeypatch.setattr(sms.time, "monotonic", lambda: clock["now"])
+    sms._refresh_env()
+    with sms._contact_cache_lock:
+        sms._invalidate_contact_cache()
+
+    def advance(seconds):
+        clock["now"] += seconds
+
+    yield fake, advance
+    monkeypatch.undo()
+    sms._refresh_env()
+    with sms._contact_cache_lock:
+        sms._invalidate_contact_cache()
+
+
+def test_board_scan_cached_within_ttl(board):
+    fake, advance = board
+
+    assert sms.lookup_contact_by_phone("+15551234567") == ("Ann", "1")
+    advance(30)
+    assert sms.lookup_contact_by_phone("+15551234567") == ("Ann", "1")
+    assert fake.calls == ["by_phone", "scan"]
+
+
+def test_unchanged_board_reused_after_ttl(board):
+    fake, advance = board
+    sms.lookup_contact_by_phone("+15551234567")
+    fake.calls.clear()
+
+    advance(61)
+    assert sms.lookup_contact_by_phone("+15551234567") == ("Ann", "1")
+    assert fake.calls == ["by_phone", "freshness"]
+
+
+def test_rescan_when_updated_at_changes(board):
+    fake, advance = board
+    sms.lookup_contact_by_phone("+15551234567")
+    fake.calls.clear()
+
+    fake.items[0] = dict(fake.items[0], name="Ann B", updated_at="2026-03-01T00:00:00Z")
+    advance(61)
+    assert sms.lookup_contact_by_phone("+15551234567") == ("Ann B", "1")
+    assert fake.calls == ["by_phone", "freshness", "scan"]
+
+
+def test_rescan_when_items_count_changes(board):
+    fake, advance = board
+    sms.lookup_contact_by_phone("+15551234567")
+    fake.calls.clear()
+
+    # Deleting the older contact leaves the newest updated_at unchanged.
+    del fake.items[0]
+    advance(61)
+    assert sms.lookup_contact_by_phone("+15551234567") is None
+    assert fake.calls == ["by_phone", "freshness", "scan"]
+
+
+def test_failed_freshness_check_falls_back_to_rescan(board):
+    fake, advance = board
+    sms.lookup_contact_by_phone("+15551234567")
+    fake.calls.clear()
+
+    fake.fail.add("freshness")
+    advance(61)
+    assert sms.lookup_contact_by_phone("+15551234567") == ("Ann", "1")
+    assert fake.calls == ["by_phone", "freshness", "scan"]
+
+
+@pytest.mark.parametrize("failing", ["by_phone", "scan"])
+def test_lookup_error_drops_saved_scan(board, failing):
+    fake, advance = board
+    sms.lookup_contact_by_phone("+15551234567")
+    fake.calls.clear()
+
+    fake.fail.add(failing)
+    # Touch the board so the failing scan is actually attempted.
+    fake.items[1] = dict(fake.items[1], updated_at="2026-03-01T00:00:00Z")
+    advance(61)
+    assert sms.lookup_contact_by_phone("+15551234567") is None
+    assert sms._contact_cache["board_index"] is None
+
+    fake.fail.clear()
+    fake.calls.clear()
+    assert sms.lookup_contact_by_phone("+15551234567") == ("Ann", "1")
+    assert fake.calls == ["by_phone", "scan"]
+
+
+def test_refresh_env_drops_saved_scan(board):
+    fake, _ = board
+    sms.lookup_contact_by_phone("+15551234567")
+    fake.calls.clear()
+
+    sms._refresh_env()
+    assert sms.lookup_contact_by_phone("+15551234567") == ("Ann", "1")
+    assert fake.calls == ["by_phone", "scan"]
+
+
+def test_cache_hit_not_blocked_by_running_scan(board, monkeypatch):
+    fake, _ = board
+    scan_started = threading.Event()
+    release_scan = threading.Event()
+    slow_post = fake.post
+
+    def post(query, variables, **kwargs):
+        if query is sms._Q_LOOKUP_BY_PHONE and "5559990000" in variables["values"]:
+            return {"data": {"items_page_by_column_values": {"items": [
+                {"id": "7", "name": "Cy", "column_values": [{"text": "555-999-0000"}]},
+            ]}}}
+        if query is sms._Q_LOOKUP:
+            scan_started.set()
+            release_scan.wait(5)
+        return slow_post(query, variables, **kwargs)
+
+    monkeypatch.setattr(sms, "_post_monday", post)
+    assert sms.lookup_contact_by_phone("+15559990000") == ("Cy", "7")
+
+    scanner = threading.Thread(target=sms.lookup_contact_by_phone, args=("+15551234567",))
+    scanner.start()
+    try:
+        assert scan_started.wait(5)
+        # The scan holds only the refresh lock, so this cached lookup returns immediately.
+        assert sms.lookup_contact_by_phone("+15559990000") == ("Cy", "7")
+        assert scanner.is_alive()
+    finally:
+        release_scan.set()
+        scanner.join(5)